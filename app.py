@@ -1,101 +1,202 @@
+import io
 import os
+import tempfile
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import python_calamine
 import streamlit as st
+import xlsxwriter
 from pathlib import Path
 from datetime import datetime
 
+# Cache JIT của numba mặc định ghi vào __pycache__ cạnh app.py (có thể read-only khi deploy)
+# → chuyển sang thư mục tạm ghi được; đặt trước khi import numba
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tti_numba_cache"))
+from numba import njit, prange
+
 # ========================
 # Core processing helpers
 # ========================
-def read_excel_safely(path, sheet, header_row):
-    """Đọc Excel theo đuôi file, fallback khi lỗi."""
-    p = Path(path)
-    suf = p.suffix.lower()
-
-    if suf == ".xlsb":
-        engine = "pyxlsb"
-    elif suf in [".xlsx", ".xlsm"]:
-        engine = "openpyxl"
-    elif suf == ".xls":
-        engine = "xlrd"
+# Giống mặc định của pandas (>= 2.0) cho openpyxl; ghi rõ để không phụ thuộc phiên bản
+OPENPYXL_READ_KWARGS = {"read_only": True, "data_only": True, "keep_links": False}
+
+# TTI_DTYPE_BACKEND=pyarrow → đọc vào cột Arrow (kernel chuỗi/số đa luồng của PyArrow;
+# pyarrow đã có sẵn vì streamlit phụ thuộc vào nó). Mặc định: numpy như cũ.
+DTYPE_BACKEND = os.environ.get("TTI_DTYPE_BACKEND", "numpy").strip().lower()
+
+
+def read_excel_safely(path, sheet, header_row, file_name=None):
+    """Đọc Excel (đường dẫn hoặc buffer) bằng calamine, fallback openpyxl khi lỗi.
+
+    Với buffer (BytesIO), đuôi file lấy từ `file_name`.
+    """
+    if isinstance(path, (str, os.PathLike)):
+        p = Path(path)
+        suf = p.suffix.lower()
     else:
+        p = path
+        suf = Path(file_name or "").suffix.lower()
+
+    if suf not in [".xlsx", ".xlsm", ".xlsb", ".xls"]:
         raise ValueError(f"Định dạng không hỗ trợ: {suf}")
 
-    # Lấy sheet đầu nếu để trống
+    # Để trống → sheet đầu (theo vị trí, không cần mở file để lấy tên)
     if sheet == "" or sheet is None:
-        xls = pd.ExcelFile(p, engine=engine)
-        sheet = xls.sheet_names[0]
+        sheet = 0
+
+    read_kwargs = {"dtype_backend": "pyarrow"} if DTYPE_BACKEND == "pyarrow" else {}
 
     try:
-        return pd.read_excel(p, sheet_name=sheet, header=header_row, engine=engine)
-    except Exception as e:
-        if suf == ".xlsb":
-            raise RuntimeError(
-                "❌ Không đọc được .xlsb. "
-                "Hãy mở file này trong Excel rồi Save As thành .xlsx để xử lý."
-            ) from e
-        raise
+        return pd.read_excel(p, sheet_name=sheet, header=header_row, engine="calamine", **read_kwargs)
+    except python_calamine.CalamineError:
+        # Chỉ fallback khi calamine không parse được file (sai tên sheet… vẫn báo lỗi ngay)
+        if suf not in [".xlsx", ".xlsm"]:
+            raise
+        if hasattr(p, "seek"):
+            p.seek(0)
+
+    # Fallback openpyxl: chỉ đọc giá trị (read-only, bỏ công thức/link)
+    return pd.read_excel(
+        p, sheet_name=sheet, header=header_row, engine="openpyxl",
+        engine_kwargs=OPENPYXL_READ_KWARGS, **read_kwargs,
+    )
 
 
 def convert_headers_to_yyyyww(cols: pd.Index):
-    """Đổi tên cột: nếu parse được ngày → đổi sang dạng YYYYWW"""
+    """Đổi tên cột: nếu parse được ngày → đổi sang dạng YYYYWW (nhãn int)"""
     s = pd.Index(cols).astype(str)
-    is_yyyyww = s.str.fullmatch(r"\d{6}", na=False)
+    # Tương đương fullmatch(r"\d{6}") nhưng chạy bằng hàm chuỗi C của NumPy
+    arr = s.to_numpy(dtype=str)
+    is_yyyyww = (np.char.str_len(arr) == 6) & np.char.isdecimal(arr)
+    if is_yyyyww.all():
+        return pd.Index(arr.astype(np.int64)), is_yyyyww
+
     to_parse = s.where(~is_yyyyww, None)
-    dt = pd.to_datetime(to_parse, errors="coerce", dayfirst=True)
+    # Header hay lặp lại → chỉ parse giá trị duy nhất rồi map ngược lại
+    codes, uniques = pd.factorize(to_parse)
+    parsed = pd.to_datetime(uniques, errors="coerce", dayfirst=True)
+    dt = parsed.take(codes, allow_fill=True, fill_value=pd.NaT)
     is_date = dt.notna()
 
-    new = s.copy().to_series()
+    # Cột tuần giữ nhãn int YYYYWW (sắp xếp/gom nhóm trên int64), cột khác giữ chuỗi
+    new = np.array(s, dtype=object)
+    new[is_yyyyww] = arr[is_yyyyww].astype(np.int64)
     if is_date.any():
         iso = dt[is_date].isocalendar()
-        new_vals = iso["year"].astype(str) + iso["week"].astype(int).map("{:02d}".format)
-        new.loc[is_date] = new_vals.to_numpy()
-    new = pd.Index(new)
+        # YYYYWW = year*100 + week, tính một lần trên cả mảng
+        new[is_date] = (iso["year"].to_numpy(dtype=np.int64) * 100
+                        + iso["week"].to_numpy(dtype=np.int64))
+    new = pd.Index(new, dtype=object)
 
     week_mask = is_yyyyww | is_date
     return new, week_mask
 
 
+@njit(parallel=True, cache=True)
+def _sum_week_groups(vals, group_ids, n_groups):
+    """Cộng cột theo nhóm (bỏ NaN), song song theo dòng; trả về (tổng, có số)."""
+    n_rows, n_cols = vals.shape
+    sums = np.zeros((n_rows, n_groups), dtype=np.float64)
+    seen = np.zeros((n_rows, n_groups), dtype=np.bool_)
+    for r in prange(n_rows):
+        for c in range(n_cols):
+            v = vals[r, c]
+            if not np.isnan(v):
+                g = group_ids[c]
+                sums[r, g] += v
+                seen[r, g] = True
+    return sums, seen
+
+
 def consolidate_weeks_fast(df: pd.DataFrame, week_mask: pd.Index, sort_week_cols=True):
     non = df.loc[:, ~week_mask]
     wk = df.loc[:, week_mask]
     if wk.shape[1] == 0:
         return df
 
-    wk_num = wk.apply(pd.to_numeric, errors="coerce")
-    wk_sum = wk_num.groupby(wk_num.columns, axis=1).sum(min_count=1)
+    # Ép số một lần trên cả khối (thay vì pd.to_numeric từng cột)
+    if all(pd.api.types.is_numeric_dtype(t) for t in wk.dtypes):
+        # Cột số (kể cả Arrow/nullable) → lấy thẳng float, NA → NaN
+        wk_num = wk.to_numpy(dtype=np.float64, na_value=np.nan)
+    else:
+        wk_num = wk.to_numpy()
+    if wk_num.dtype == object:
+        wk_num = pd.to_numeric(wk_num.ravel(), errors="coerce").reshape(wk_num.shape)
+    wk_num = wk_num.astype(np.float64, copy=False)
+
+    # Cộng các cột trùng tên: sắp xếp ổn định theo tên → mỗi nhóm là một đoạn liên tiếp
+    cols = wk.columns.to_numpy().astype(np.int64)
+    order = np.argsort(cols, kind="stable")
+    sorted_cols = cols[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cols[1:] != sorted_cols[:-1]])
 
-    # Nếu toàn NaN thì giữ cột gốc
-    groups = {}
-    for c in wk.columns:
-        groups.setdefault(c, []).append(c)
-    for name, cols in groups.items():
-        sub_num = wk_num[cols]
-        if not sub_num.notna().any().any():
-            wk_sum[name] = wk[cols[0]]
+    # Kernel numba: duyệt khối gốc một lần, không cần sắp xếp lại cột
+    group_ids = np.empty(len(cols), dtype=np.int64)
+    group_ids[order] = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(cols)]))
+    sums, seen = _sum_week_groups(np.ascontiguousarray(wk_num), group_ids, len(starts))
+    sums[~seen] = np.nan  # min_count=1
+    wk_sum = pd.DataFrame(sums, index=wk.index, columns=sorted_cols[starts])
 
-    wk_sum = wk_sum.loc[:, ~wk_sum.columns.duplicated(keep="last")]
+    # Nếu toàn NaN thì giữ cột gốc (cột đầu tiên của nhóm)
+    grp_has_num = seen.any(axis=0)
+    for i in np.flatnonzero(~grp_has_num):
+        wk_sum.isetitem(i, wk.iloc[:, order[starts[i]]].to_numpy())
 
     if sort_week_cols:
-        def wkey(x):
-            xs = str(x)
-            return (0, int(xs)) if xs.isdigit() and len(xs) == 6 else (1, xs)
-        wk_sum = wk_sum[sorted(wk_sum.columns, key=wkey)]
+        # Nhãn tuần đã là int64 → np.argsort trực tiếp
+        wk_sum = wk_sum.iloc[:, np.argsort(wk_sum.columns.to_numpy(), kind="stable")]
 
-    return pd.concat([non, wk_sum], axis=1)
+    # Cùng index → không cần align; copy=False gắn thẳng block, không copy cả frame
+    return pd.concat([non, wk_sum], axis=1, copy=False)
 
 
 def filter_firm_forecast_colB(df: pd.DataFrame) -> pd.DataFrame:
     """Giữ lại dòng có colB = Firm hoặc Forecast"""
     if df.shape[1] <= 1:
         return df
-    col = df.iloc[:, 1].astype(str).str.strip().str.lower()
-    mask = col.isin(["firm", "forecast"])
+    col = df.iloc[:, 1]
+    if isinstance(col.dtype, (pd.ArrowDtype, pd.StringDtype)) and col.dtype.storage == "pyarrow":
+        # Cột Arrow (TTI_DTYPE_BACKEND=pyarrow) → dùng kernel compute của PyArrow, không qua object
+        arr = pa.array(col)
+        if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+            norm = pc.utf8_lower(pc.utf8_trim_whitespace(arr))
+            mask = pc.fill_null(pc.is_in(norm, value_set=pa.array(["firm", "forecast"])), False)
+            return df.loc[mask.to_numpy(zero_copy_only=False)].copy()
+
+    # Chuẩn hoá (strip/lower) trên giá trị duy nhất rồi map ngược theo mã
+    codes, uniques = pd.factorize(col)
+    keep = uniques.astype(str).str.strip().str.lower().isin(["firm", "forecast"])
+    mask = np.append(keep, False)[codes]  # mã -1 (NaN) → False
     return df.loc[mask].copy()
 
 
-def process_excel(file, sheet_name, header_row):
-    df = read_excel_safely(file, sheet_name, header_row)
+def write_excel_streaming(df: pd.DataFrame, out) -> None:
+    """Ghi xlsx từng dòng với constant_memory (không giữ cả sheet trong RAM).
+
+    Không dùng df.to_excel vì pandas ghi theo cột, làm mất dữ liệu ở chế độ constant_memory.
+    """
+    wb = xlsxwriter.Workbook(out, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        "remove_timezone": True,
+    })
+    ws = wb.add_worksheet("Sheet1")
+    ws.write_row(0, 0, [str(c) for c in df.columns])
+    # NaN/NaT/NA → ô trống, ±inf → "inf"/"-inf" như inf_rep mặc định của df.to_excel.
+    # Làm trên mảng object của numpy để pandas không downcast None ngược về NaN/NaT.
+    body = df.to_numpy(dtype=object, copy=True)
+    body[df.isna().to_numpy()] = None
+    body[body == np.inf] = "inf"
+    body[body == -np.inf] = "-inf"
+    for r, row in enumerate(body, start=1):
+        ws.write_row(r, 0, row)
+    wb.close()
+
+
+def process_excel(file, sheet_name, header_row, file_name=None):
+    df = read_excel_safely(file, sheet_name, header_row, file_name=file_name)
     df = filter_firm_forecast_colB(df)
 
     new_cols, week_mask = convert_headers_to_yyyyww(pd.Index(df.columns))
@@ -107,40 +208,59 @@ def process_excel(file, sheet_name, header_row):
 # ========================
 # Streamlit App
 # ========================
+@st.cache_data(show_spinner=False, max_entries=8)
+def process_excel_cached(file_bytes: bytes, sheet_name, header_row, file_name) -> pd.DataFrame:
+    """Cache theo nội dung file + tham số: bấm Process lại không phải xử lý lại."""
+    return process_excel(io.BytesIO(file_bytes), sheet_name, header_row, file_name=file_name)
+
+
 st.set_page_config(page_title="Convert Header to YYYYWW", layout="wide")
 st.title("📊 Convert Header to YYYYWW")
 
 uploaded_file = st.file_uploader("Upload Excel file", type=["xlsx", "xlsm", "xls", "xlsb"])
 sheet_name = st.text_input("Sheet name (để trống = sheet đầu)", value="")
 header_row = st.number_input("Header row (0-based)", min_value=0, max_value=100, value=0, step=1)
+out_fmt = st.radio("Output format", ["csv", "parquet", "xlsx"], horizontal=True)
 
 if uploaded_file:
     if st.button("Process"):
         try:
-            # Lưu file upload vào tạm
-            suffix = Path(uploaded_file.name).suffix
-            temp_path = Path("temp_input" + suffix)
-            with open(temp_path, "wb") as f:
-                f.write(uploaded_file.read())
-
-            # Xử lý
-            df = process_excel(temp_path, sheet_name.strip(), int(header_row))
+            # Xử lý trực tiếp từ bộ nhớ, không ghi file tạm
+            df = process_excel_cached(
+                uploaded_file.getvalue(),
+                sheet_name.strip(),
+                int(header_row),
+                uploaded_file.name,
+            )
 
             st.success("✅ Xử lý thành công!")
             st.dataframe(df.head(50))  # hiển thị preview
 
-            # Xuất ra file Excel tải về
+            # Xuất file tải về (CSV mặc định, xlsx chậm hơn nhiều)
             today_str = datetime.today().strftime("%Y%m%d")
-            out_name = f"{today_str}.xlsx"
-            df.to_excel(out_name, index=False, engine="xlsxwriter")
-
-            with open(out_name, "rb") as f:
-                st.download_button(
-                    label="📥 Download output",
-                    data=f,
-                    file_name=out_name,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            out_name = f"{today_str}.{out_fmt}"
+            buf = io.BytesIO()
+            if out_fmt == "csv":
+                df.to_csv(buf, index=False, encoding="utf-8-sig")
+                mime = "text/csv"
+            elif out_fmt == "parquet":
+                # Parquet cần nhãn cột kiểu chuỗi (nhãn tuần đang là int) và kiểu cột thống nhất
+                # → cột object (có thể lẫn số/chữ) ghi dạng chuỗi
+                pq_df = df.rename(columns=str)
+                obj_cols = pq_df.select_dtypes(include="object").columns
+                pq_df[obj_cols] = pq_df[obj_cols].astype("string")
+                pq_df.to_parquet(buf, index=False)
+                mime = "application/vnd.apache.parquet"
+            else:
+                write_excel_streaming(df, buf)
+                mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+            st.download_button(
+                label="📥 Download output",
+                data=buf.getvalue(),
+                file_name=out_name,
+                mime=mime
+            )
 
         except Exception as e:
             st.error(f"❌ Lỗi: {e}")